@@ -1,15 +1,28 @@
+import functools
 import io
 import hashlib
+import os
+import pickle
+import re
 import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from xml.etree import ElementTree
 
 import openpyxl
 import pandas as pd
 import streamlit as st
-from openpyxl.utils import get_column_letter
+from python_calamine import CalamineWorkbook
+from openpyxl.utils import coordinate_to_tuple, range_boundaries
 from xlcalculator import Evaluator, model, xltypes
 from xlcalculator.xlfunctions import func_xltypes, logical, xl
 
+try:
+    from blake3 import blake3
+except ImportError:  # blake3 é opcional; sem ele o sha256 resolve
+    blake3 = None
+
 # =========================
 # STREAMLIT CONFIG + HEARTBEAT
 # =========================
@@ -31,6 +44,16 @@ PREFERRED_FILES = [
     "Cópia de Simulador Economia Circular Verde (v.27.03.2025) (2).xlsx",
 ]
 
+# Janela opcional onde os inputs vivem (ex.: "A1:Z200"). None varre a aba
+# inteira; defina uma janela se a planilha tiver formatação perdida muito
+# abaixo/à direita da área útil, para o scan parar cedo.
+INPUT_WINDOW: str | None = None
+
+# Cache em disco do Model construído (sobrevive a restarts do processo,
+# diferente do @st.cache_resource)
+ENGINE_CACHE_DIR = Path(".cache")
+ENGINE_CACHE_KEEP = 4  # quantos modelos pickled manter (LRU por mtime)
+
 # Ajuste depois para os KPIs reais (células)
 OUTPUT_CELLS = {
     "💰 Economia Total": f"{MAIN_SHEET}!M12",
@@ -42,8 +65,8 @@ OUTPUT_CELLS = {
 # =========================
 # HELPERS
 # =========================
-def find_workbook_in_cwd() -> Path | None:
-    """Procura um .xlsx válido na pasta atual, priorizando nomes conhecidos."""
+@functools.lru_cache(maxsize=1)
+def _find_workbook_in_cwd() -> Path | None:
     cwd = Path(".").resolve()
 
     # 1) prioriza nomes conhecidos
@@ -52,99 +75,253 @@ def find_workbook_in_cwd() -> Path | None:
         if p.exists() and p.is_file() and not p.name.startswith("~$"):
             return p
 
-    # 2) fallback: primeiro xlsx válido encontrado
-    for p in cwd.glob("*.xlsx"):
-        if p.is_file() and not p.name.startswith("~$"):
-            return p
+    # 2) fallback: primeiro xlsx válido encontrado (scandir reaproveita o
+    # stat da listagem, sem um syscall extra por entrada como glob+is_file)
+    for entry in os.scandir(cwd):
+        if (
+            entry.name.endswith(".xlsx")
+            and not entry.name.startswith("~$")
+            and entry.is_file()
+        ):
+            return Path(entry.path)
 
     return None
 
 
-def is_formula(value) -> bool:
-    return isinstance(value, str) and value.startswith("=")
+def find_workbook_in_cwd() -> Path | None:
+    """
+    Procura um .xlsx válido na pasta atual, priorizando nomes conhecidos.
+
+    Só o acerto fica memoizado (o Streamlit reexecuta o script inteiro a
+    cada interação e um arquivo encontrado não muda durante a vida do
+    processo); um miss é descartado para que um .xlsx colocado na pasta
+    depois seja visto no próximo rerun.
+    """
+    path = _find_workbook_in_cwd()
+    if path is None:
+        _find_workbook_in_cwd.cache_clear()
+    return path
 
 
-def is_probably_input_cell(cell) -> bool:
+# Namespaces do pacote OOXML, para o parse direto dos XMLs do .xlsx
+_SSML = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_RELS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+
+def _input_style_ids(zf: zipfile.ZipFile) -> frozenset:
     """
-    Heurística para detectar células de input:
-    - não é fórmula
-    - tem valor
-    - e tem fill sólido com theme 7 (ajuste se precisar)
+    Índices de estilo (cellXfs) cujo fill é sólido com theme 7 (a marcação
+    de célula de input — ajuste se precisar), lidos direto do xl/styles.xml
+    em streaming, sem instanciar objetos de estilo do openpyxl.
     """
-    v = cell.value
-    if v is None or v == "":
-        return False
-    if is_formula(v):
-        return False
+    target_fills = set()
+    style_ids = set()
+    fill_idx = 0
+    xf_idx = 0
+    in_cellxfs = False
+
+    with zf.open("xl/styles.xml") as f:
+        for event, el in ElementTree.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if el.tag == f"{_SSML}cellXfs":
+                    in_cellxfs = True
+                continue
+            if el.tag == f"{_SSML}fill":
+                pattern = el.find(f"{_SSML}patternFill")
+                if pattern is not None and pattern.get("patternType") == "solid":
+                    fg = pattern.find(f"{_SSML}fgColor")
+                    if fg is not None and fg.get("theme") == "7":
+                        target_fills.add(fill_idx)
+                fill_idx += 1
+                el.clear()
+            elif el.tag == f"{_SSML}xf" and in_cellxfs:
+                if int(el.get("fillId", "0")) in target_fills:
+                    style_ids.add(xf_idx)
+                xf_idx += 1
+            elif el.tag == f"{_SSML}cellXfs":
+                in_cellxfs = False
+
+    return frozenset(style_ids)
+
+
+def _sheet_xml_path(zf: zipfile.ZipFile, sheet_name: str) -> str | None:
+    """Resolve o caminho do XML da aba dentro do pacote (via rels)."""
+    rel_id = None
+    with zf.open("xl/workbook.xml") as f:
+        for _, el in ElementTree.iterparse(f, events=("end",)):
+            if el.tag == f"{_SSML}sheet" and el.get("name") == sheet_name:
+                rel_id = el.get(f"{_RELS}id")
+
+    if rel_id is None:
+        return None
+
+    with zf.open("xl/_rels/workbook.xml.rels") as f:
+        for _, el in ElementTree.iterparse(f, events=("end",)):
+            if el.tag.endswith("Relationship") and el.get("Id") == rel_id:
+                target = el.get("Target")
+                return target if target.startswith("xl/") else f"xl/{target}"
+
+    return None
 
-    fill = cell.fill
-    if fill and fill.patternType == "solid" and fill.fgColor and fill.fgColor.type == "theme":
-        if fill.fgColor.theme == 7:
-            return True
 
-    return False
+def _scan_input_cells_xml(xlsx_bytes: bytes, sheet_name: str, window: str | None = None):
+    """
+    Endereços ("C20") das células candidatas a input, direto do XML da aba:
+    estilo na tabela de inputs, com valor e sem fórmula. Streaming puro —
+    nenhum objeto Cell/PatternFill do openpyxl é criado. Com uma janela
+    ("A1:Z200"), células fora dela são descartadas e o scan para assim que
+    passa da última linha útil — formatação perdida lá embaixo não custa
+    nada além do parse do XML até o break.
+    """
+    bounds = range_boundaries(window) if window else None
+
+    with zipfile.ZipFile(io.BytesIO(xlsx_bytes)) as zf:
+        style_ids = _input_style_ids(zf)
+        if not style_ids:
+            return []
+
+        sheet_path = _sheet_xml_path(zf, sheet_name)
+        if sheet_path is None:
+            return []
+
+        c_tag = f"{_SSML}c"
+        f_tag = f"{_SSML}f"
+        v_tag = f"{_SSML}v"
+        is_tag = f"{_SSML}is"
+        row_tag = f"{_SSML}row"
+
+        found = []
+        with zf.open(sheet_path) as f:
+            for _, el in ElementTree.iterparse(f, events=("end",)):
+                tag = el.tag
+                if tag == row_tag:
+                    past_window = bounds and int(el.get("r") or 0) >= bounds[3]
+                    el.clear()
+                    if past_window:
+                        break
+                    continue
+                if tag != c_tag:
+                    continue
+                s = el.get("s")
+                if (
+                    s is not None
+                    and int(s) in style_ids
+                    and el.find(f_tag) is None
+                    and (el.find(v_tag) is not None or el.find(is_tag) is not None)
+                ):
+                    coord = el.get("r")
+                    if bounds:
+                        r, c = coordinate_to_tuple(coord)
+                        if not (
+                            bounds[0] <= c <= bounds[2] and bounds[1] <= r <= bounds[3]
+                        ):
+                            el.clear()
+                            continue
+                    found.append(coord)
+                el.clear()
+        return found
+
+
+def _fast_scan_values(xlsx_bytes: bytes, sheet_name: str):
+    """
+    Lê os valores da aba via calamine (Rust), bem mais rápido que o parse
+    XML do openpyxl. Retorna a grade (linhas × colunas) de valores, ou None
+    se a aba não existir.
+    """
+    cwb = CalamineWorkbook.from_filelike(io.BytesIO(xlsx_bytes))
+    if sheet_name not in cwb.sheet_names:
+        return None
+    # skip_empty_area=False ancora a grade em A1, mantendo os índices
+    # (linha, coluna) alinhados com os do openpyxl
+    return cwb.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False)
 
 
-def discover_inputs(wb: openpyxl.Workbook, sheet_name: str):
-    if sheet_name not in wb.sheetnames:
+def discover_inputs(xlsx_bytes: bytes, sheet_name: str):
+    """
+    Descobre as células de input da aba sem passar pelo openpyxl: o XML da
+    aba é percorrido em streaming para achar as células com estilo de input
+    e a grade calamine fornece valores tipados e os labels da coluna B.
+    """
+    values = _fast_scan_values(xlsx_bytes, sheet_name)
+    if values is None:
+        cwb = CalamineWorkbook.from_filelike(io.BytesIO(xlsx_bytes))
         raise ValueError(
             f"Aba '{sheet_name}' não encontrada.\n"
-            f"Abas disponíveis: {wb.sheetnames}"
+            f"Abas disponíveis: {cwb.sheet_names}"
         )
 
-    ws = wb[sheet_name]
-
     inputs = []
-    for r in range(1, ws.max_row + 1):
-        for c in range(1, ws.max_column + 1):
-            cell = ws.cell(r, c)
-            if not is_probably_input_cell(cell):
-                continue
+    sheet_prefix = sheet_name + "!"  # pré-montado, em vez de um f-string por célula
+    # o XML entrega as células já em ordem (linha, coluna)
+    for coord in _scan_input_cells_xml(xlsx_bytes, sheet_name, window=INPUT_WINDOW):
+        r, c = coordinate_to_tuple(coord)
+        if r > len(values) or c > len(values[r - 1]):
+            continue
+        default = values[r - 1][c - 1]
+        if default is None or default == "":
+            continue
+
+        addr = sheet_prefix + coord
+
+        # tenta label na coluna B da mesma linha
+        label = values[r - 1][1] if len(values[r - 1]) >= 2 else None
+        label = str(label).strip() if label else addr
+
+        inputs.append(
+            {
+                "label": label,
+                "address": addr,
+                "default": default,
+                "row": r,
+                "col": c,
+            }
+        )
 
-            addr = f"{sheet_name}!{get_column_letter(c)}{r}"
+    return inputs
 
-            # tenta label na coluna B da mesma linha
-            label = ws.cell(r, 2).value
-            label = str(label).strip() if label else addr
 
-            inputs.append(
-                {
-                    "label": label,
-                    "address": addr,
-                    "default": cell.value,
-                    "row": r,
-                    "col": c,
-                }
-            )
+_BOOLS = {"true": True, "false": False}
 
-    inputs.sort(key=lambda x: (x["row"], x["col"]))
-    return inputs
 
+def coerce_values(s: pd.Series) -> pd.Series:
+    """
+    Converte a coluna de valores inteira de uma vez: strings numéricas
+    PT-BR (vírgula) viram float e 'true'/'false' viram bool via kernels C
+    do pandas, em vez de um apply por linha.
+    """
+    raw = s.astype("string").str.strip()
+    bools = raw.str.lower().map(_BOOLS)
+
+    # PT-BR: se tem vírgula, remove separador de milhar e troca a vírgula
+    # decimal; sem vírgula o texto vai direto para o to_numeric
+    num = raw.where(
+        ~raw.str.contains(",", regex=False),
+        raw.str.replace(".", "", regex=False).str.replace(",", ".", regex=False),
+    )
+    parsed = pd.to_numeric(num, errors="coerce")
 
-def coerce_value(v):
-    """Converte strings numéricas PT-BR (vírgula) para float quando fizer sentido."""
-    if v is None:
-        return None
-    if isinstance(v, (int, float, bool)):
-        return v
+    # resultado em dtype object: o data_editor entrega a coluna como dtype
+    # de string (Arrow), que não aceita receber floats/bools de volta
+    out = s.astype(object)
+    out[parsed.notna()] = parsed[parsed.notna()]
+    out[bools.notna()] = bools[bools.notna()]
+    return out
 
-    if isinstance(v, str):
-        s = v.strip()
-        if s.lower() in ("true", "false"):
-            return s.lower() == "true"
 
-        if "," in s:
-            s2 = s.replace(".", "").replace(",", ".")
+def set_cell_values(evaluator: Evaluator, values: dict) -> None:
+    """
+    Aplica vários inputs de uma vez escrevendo direto em model.cells, em vez
+    de um set_cell_value por célula (que resolve defined_names e copia o
+    valor a cada chamada). A invalidação fica por conta do recomputo
+    incremental no Calcular.
+    """
+    cells = evaluator.model.cells
+    for addr, val in values.items():
+        cell = cells.get(addr)
+        if cell is None:
+            cells[addr] = xltypes.XLCell(addr, val)
         else:
-            s2 = s
-
-        try:
-            if any(ch.isdigit() for ch in s2):
-                return float(s2)
-        except Exception:
-            return v
-
-    return v
+            cell.value = val
 
 
 def safe_eval(evaluator: Evaluator, addr: str):
@@ -154,14 +331,22 @@ def safe_eval(evaluator: Evaluator, addr: str):
         return f"Erro: {e}"
 
 
+# tipos que já são valores Python simples: caminho rápido do unwrap
+_SIMPLE_TYPES = frozenset((int, float, str, bool))
+
+
 def _unwrap_excel_value(val):
     """Converte ExcelTypes / Arrays do xlcalculator em valores Python simples."""
+    if type(val) in _SIMPLE_TYPES:  # caso comum: nada a converter
+        return val
     if isinstance(val, func_xltypes.Expr):
         val = val()
+        if type(val) in _SIMPLE_TYPES:
+            return val
     if isinstance(val, func_xltypes.Array):
         flat = list(val.values.flat)
         return _unwrap_excel_value(flat[0]) if flat else None
-    if hasattr(val, "value") and not isinstance(val, (int, float, str, bool)):
+    if hasattr(val, "value"):
         try:
             return val.value
         except Exception:
@@ -177,64 +362,294 @@ def IF_SAFE(
     value_if_true: func_xltypes.XlExpr = True,
     value_if_false: func_xltypes.XlExpr = False,
 ):
-    cond = _unwrap_excel_value(logical_test)
-    true_fn = value_if_true if callable(value_if_true) else lambda: value_if_true
-    false_fn = value_if_false if callable(value_if_false) else lambda: value_if_false
-    chosen = true_fn if bool(cond) else false_fn
-    return _unwrap_excel_value(chosen())
+    # IF é uma das funções mais chamadas do motor: unwrap em local e um
+    # único teste de callable, só no ramo escolhido (depois do
+    # validate_args os ramos normalmente já são XlExpr; o teste cobre os
+    # defaults True/False)
+    unwrap = _unwrap_excel_value
+    chosen = value_if_true if bool(unwrap(logical_test)) else value_if_false
+    return unwrap(chosen() if callable(chosen) else chosen)
 
 
 logical.IF = IF_SAFE
 xl.FUNCTIONS["IF"] = IF_SAFE
 
 
+# Referência de coluna inteira ("Taxas Bandeira!A:N"), para clampar à área
+# usada da aba: o XLRange materializa cada endereço do intervalo no
+# __post_init__, e uma coluna inteira crua viraria 1M+ de linhas (vários
+# segundos e centenas de MB) por range.
+_FULLCOL_RE = re.compile(r"^(.+)!\$?([A-Z]{1,3}):\$?([A-Z]{1,3})$")
+
+
+def _range_addresses(range_keys, sheet_max_rows):
+    """Mapa chave do range -> endereço a materializar (coluna inteira
+    clampada à última linha usada da aba; o resto passa direto)."""
+    addrs = {}
+    for key in range_keys:
+        m = _FULLCOL_RE.match(key)
+        if m:
+            sheet, col1, col2 = m.groups()
+            max_row = sheet_max_rows.get(sheet)
+            if max_row:
+                addrs[key] = f"{sheet}!{col1}1:{col2}{max_row}"
+                continue
+        addrs[key] = key
+    return addrs
+
+
+# Referências de range no texto cru da fórmula: prefixo de aba opcional
+# (com ou sem aspas) seguido de A1:B2 ou de colunas inteiras A:N, com ou
+# sem $. Gera as mesmas chaves que os terms do tokenizer do xlcalculator
+# (aba sem aspas, $ preservado, prefixo da própria aba quando omitido).
+_RANGE_RE = re.compile(
+    r"(?:'([^']+)'!|([^\s!='\",()+\-*/;:<>&^%]+)!)?"
+    r"(\$?[A-Z]{1,3}\$?\d+:\$?[A-Z]{1,3}\$?\d+"
+    r"|\$?[A-Z]{1,3}:\$?[A-Z]{1,3})"
+)
+
+
+def _scan_sheet(ws):
+    """Varre uma aba e devolve (cells, formulae, range_keys) para o merge."""
+    # pré-liga classes e funções em locais: evita um lookup de atributo por célula
+    XLCell = xltypes.XLCell
+    XLFormula = xltypes.XLFormula
+    find_ranges = _RANGE_RE.finditer
+
+    sheet = ws.title
+    prefix = sheet + "!"
+    cells_buf = {}
+    formulae_buf = {}
+    range_keys = set()
+
+    for row in ws.iter_rows():
+        for cell in row:
+            v = cell.value
+            if v is None:
+                continue
+
+            addr = prefix + cell.coordinate
+            has_formula = type(v) is str and v[:1] == "="
+            xl_cell = XLCell(addr, value=None if has_formula else v)
+
+            if has_formula:
+                formula = XLFormula(v, sheet_name=sheet, reference=addr)
+                xl_cell.formula = formula
+                formulae_buf[addr] = formula
+                # regex direto no texto da fórmula, sem re-percorrer os
+                # tokens; a deduplicação fica por conta do set
+                if ":" in v:
+                    for m in find_ranges(v):
+                        range_keys.add(
+                            f"{m.group(1) or m.group(2) or sheet}!{m.group(3)}"
+                        )
+
+            cells_buf[addr] = xl_cell
+
+    return cells_buf, formulae_buf, range_keys
+
+
 def build_model_from_workbook(wb: openpyxl.Workbook) -> model.Model:
     """
     Constrói um Model manualmente (mais leve que ModelCompiler para esta planilha).
     - Só cria ranges quando há ":" (intervalos reais), evitando Arrays 1x1.
+    - As abas são varridas em paralelo (threads); os buffers por aba são
+      mesclados em bloco no final.
     """
     mdl = model.Model()
 
-    for ws in wb.worksheets:
-        sheet = ws.title
-        for row in ws.iter_rows():
-            for cell in row:
-                v = cell.value
-                if v is None:
-                    continue
+    worksheets = wb.worksheets
+    if len(worksheets) > 1:
+        max_workers = min(len(worksheets), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_scan_sheet, worksheets))
+    else:
+        results = [_scan_sheet(ws) for ws in worksheets]
+
+    # merge em bloco: um update em C por aba em vez de um setitem por célula
+    range_keys = set()
+    for cells_buf, formulae_buf, keys in results:
+        mdl.cells.update(cells_buf)
+        mdl.formulae.update(formulae_buf)
+        range_keys |= keys
+
+    # o range fica registrado sob a chave original (é ela que o RangeNode
+    # procura), mas materializa só até a área usada da aba
+    sheet_max_rows = {ws.title: ws.max_row for ws in worksheets}
+    mdl.ranges.update(
+        {
+            key: xltypes.XLRange(addr, key)
+            for key, addr in _range_addresses(range_keys, sheet_max_rows).items()
+        }
+    )
 
-                addr = f"{sheet}!{cell.coordinate}"
-                has_formula = isinstance(v, str) and v.startswith("=")
-                xl_cell = xltypes.XLCell(addr, value=None if has_formula else v)
+    mdl.build_code()
+    return mdl
 
-                if has_formula:
-                    xl_cell.formula = xltypes.XLFormula(
-                        v, sheet_name=sheet, reference=addr
-                    )
-                    for term in xl_cell.formula.terms:
-                        if ":" in term and term not in mdl.ranges:
-                            mdl.ranges[term] = xltypes.XLRange(term, term)
 
-                mdl.cells[addr] = xl_cell
-                if xl_cell.formula:
-                    mdl.formulae[addr] = xl_cell.formula
+def _precedent_eval_order(mdl: model.Model, targets):
+    """
+    Ordem topológica (Kahn) das células com fórmula que são precedentes
+    transitivos dos KPIs. Precedentes vêm antes de dependentes, então uma
+    passada na ordem avalia cada fórmula compartilhada uma única vez.
 
-    mdl.build_code()
-    return mdl
+    Retorna (ordem, dependentes); dependentes mapeia cada célula (input ou
+    fórmula) para as fórmulas imediatamente a jusante, para o recomputo
+    incremental no botão Calcular.
+    """
+    formulae = mdl.formulae
+    ranges = mdl.ranges
+    known = mdl.cells
+
+    def precedent_cells(addr):
+        # só endereços que existem no modelo interessam; expandir ranges de
+        # coluna inteira célula a célula explodiria o mapa de dependentes
+        out = []
+        for term in formulae[addr].terms:
+            if ":" in term:
+                rng = ranges.get(term) or xltypes.XLRange(term, term)
+                for row_addrs in rng.cells:
+                    out.extend(a for a in row_addrs if a in known)
+            else:
+                out.append(term)
+        return out
+
+    deps = {}        # fórmula -> precedentes que também são fórmulas
+    dependents = {}  # célula -> fórmulas imediatamente a jusante
+    stack = [addr for addr in targets if addr in formulae]
+    while stack:
+        addr = stack.pop()
+        if addr in deps:
+            continue
+        f_deps = set()
+        for prec in precedent_cells(addr):
+            dependents.setdefault(prec, set()).add(addr)
+            if prec in formulae:
+                f_deps.add(prec)
+                stack.append(prec)
+        deps[addr] = f_deps
+
+    pending = {addr: len(d) for addr, d in deps.items()}
+    rev = {}
+    for addr, d in deps.items():
+        for prec in d:
+            rev.setdefault(prec, []).append(addr)
+
+    ready = [addr for addr, n in pending.items() if n == 0]
+    order = []
+    while ready:
+        addr = ready.pop()
+        order.append(addr)
+        for dep in rev.get(addr, ()):
+            pending[dep] -= 1
+            if pending[dep] == 0:
+                ready.append(dep)
+
+    # ciclo (referência circular na planilha): anexa o resto e deixa o
+    # evaluator lidar como antes
+    if len(order) < len(deps):
+        order.extend(addr for addr, n in pending.items() if n > 0)
+
+    return order, dependents
+
+
+def _dirty_descendants(dependents, changed):
+    """Fórmulas a jusante (transitivas) das células alteradas."""
+    dirty = set()
+    stack = list(changed)
+    while stack:
+        addr = stack.pop()
+        for dep in dependents.get(addr, ()):
+            if dep not in dirty:
+                dirty.add(dep)
+                stack.append(dep)
+    return dirty
+
+
+def _digest_bytes(data: bytes) -> str:
+    """
+    Hash do .xlsx para a chave do cache em disco. blake3 usa SIMD largo e
+    hashing em árvore (~3-5× o sha256 em arquivos grandes); sha256 fica de
+    fallback quando a lib não está instalada.
+    """
+    if blake3 is not None:
+        return blake3(data).hexdigest()
+    return hashlib.sha256(data).hexdigest()
 
 
-@st.cache_resource(hash_funcs={bytes: lambda b: hashlib.sha256(b).hexdigest()})
-def load_engine_from_bytes(xlsx_bytes: bytes):
-    wb = openpyxl.load_workbook(io.BytesIO(xlsx_bytes), data_only=False)
-    mdl = build_model_from_workbook(wb)
-    return Evaluator(mdl)
+def _engine_cache_path(digest: str) -> Path:
+    return ENGINE_CACHE_DIR / f"engine-{digest}.pkl"
 
 
-@st.cache_data
-def cached_inputs(xlsx_bytes: bytes, sheet_name: str):
-    with io.BytesIO(xlsx_bytes) as bio:
-        wb = openpyxl.load_workbook(bio, data_only=False)
-    return discover_inputs(wb, sheet_name)
+def _load_model_from_cache(digest: str):
+    """Tenta reaproveitar um Model já construído para estes bytes."""
+    path = _engine_cache_path(digest)
+    try:
+        with open(path, "rb") as f:
+            mdl, range_addrs = pickle.load(f)
+        # os ranges entram no pickle só como (chave, endereço clampado) e
+        # são reconstruídos aqui; ver o comentário em _store_model_in_cache
+        mdl.ranges = {
+            key: xltypes.XLRange(addr, key) for key, addr in range_addrs.items()
+        }
+        path.touch()  # marca como usado recentemente (para o LRU)
+        return mdl
+    except Exception:
+        return None
+
+
+def _store_model_in_cache(digest: str, mdl) -> None:
+    """Grava o Model em .cache/ e descarta os menos usados recentemente."""
+    try:
+        ENGINE_CACHE_DIR.mkdir(exist_ok=True)
+        # mdl.ranges fica de fora do pickle: os XLRange materializam a
+        # expansão célula a célula e inflariam a entrada; persistimos só o
+        # mapa chave -> endereço (já clampado) e reconstruímos no load.
+        ranges = mdl.ranges
+        mdl.ranges = {}
+        try:
+            range_addrs = {key: rng.address_str for key, rng in ranges.items()}
+            with open(_engine_cache_path(digest), "wb") as f:
+                pickle.dump((mdl, range_addrs), f, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            mdl.ranges = ranges
+        cached = sorted(
+            ENGINE_CACHE_DIR.glob("engine-*.pkl"), key=lambda p: p.stat().st_mtime
+        )
+        for old in cached[:-ENGINE_CACHE_KEEP]:
+            old.unlink(missing_ok=True)
+    except Exception:
+        # cache é melhor esforço; sem ele o app só fica mais lento
+        pass
+
+
+@st.cache_resource
+def load_engine_from_bytes(_xlsx_bytes: bytes, cache_key):
+    """Retorna (evaluator, inputs) num único recurso cacheado por arquivo."""
+    # _xlsx_bytes tem underscore para o Streamlit não hashear o arquivo
+    # inteiro a cada rerun; cache_key ((nome, tamanho, mtime)) decide o hit.
+    # O digest abaixo só roda no miss, para o cache em disco.
+    digest = _digest_bytes(_xlsx_bytes)
+    mdl = _load_model_from_cache(digest)
+    if mdl is None:
+        # Modo normal (não read_only): precisamos das fórmulas célula a célula.
+        # keep_vba/keep_links desligados evitam parse de partes irrelevantes.
+        wb = openpyxl.load_workbook(
+            io.BytesIO(_xlsx_bytes), data_only=False, keep_vba=False, keep_links=False
+        )
+        mdl = build_model_from_workbook(wb)
+        _store_model_in_cache(digest, mdl)
+
+    evaluator = Evaluator(mdl)
+    # ordem de avaliação restrita aos precedentes dos KPIs, calculada uma vez
+    evaluator._eval_order, evaluator._dependents = _precedent_eval_order(
+        mdl, OUTPUT_CELLS.values()
+    )
+
+    # a descoberta de inputs entra no mesmo recurso cacheado: uma entrada
+    # por arquivo, sem uma segunda camada de cache hasheando os bytes
+    inputs = discover_inputs(_xlsx_bytes, MAIN_SHEET)
+    return evaluator, inputs
 
 
 # =========================
@@ -247,18 +662,32 @@ with st.expander("📤 (Opcional) Trocar planilha por upload", expanded=False):
     )
     st.info("Se você não fizer upload, o app usa o .xlsx encontrado na pasta do projeto.")
 
-xlsx_bytes: bytes | None = None
-xlsx_name: str | None = None
 xlsx_path: Path | None = None
 
+# Os bytes ficam em session_state, chaveados pela origem do arquivo
+# ((nome, tamanho, mtime) no disco; (nome, tamanho) no upload): a cada rerun
+# só há releitura/re-parse se o arquivo de fato mudou.
+xlsx_key = None
 if uploaded is not None:
-    xlsx_bytes = uploaded.getvalue()
-    xlsx_name = uploaded.name
+    xlsx_key = ("upload", uploaded.name, uploaded.size)
+    if st.session_state.get("xlsx_key") != xlsx_key:
+        st.session_state["xlsx_key"] = xlsx_key
+        st.session_state["xlsx_bytes"] = uploaded.getvalue()
+        st.session_state["xlsx_name"] = uploaded.name
+        st.session_state.pop("xlsx_sheetnames", None)
 else:
     xlsx_path = find_workbook_in_cwd()
     if xlsx_path:
-        xlsx_bytes = xlsx_path.read_bytes()
-        xlsx_name = xlsx_path.name
+        stat = xlsx_path.stat()
+        xlsx_key = (str(xlsx_path), stat.st_size, stat.st_mtime_ns)
+        if st.session_state.get("xlsx_key") != xlsx_key:
+            st.session_state["xlsx_key"] = xlsx_key
+            st.session_state["xlsx_bytes"] = xlsx_path.read_bytes()
+            st.session_state["xlsx_name"] = xlsx_path.name
+            st.session_state.pop("xlsx_sheetnames", None)
+
+xlsx_bytes: bytes | None = st.session_state.get("xlsx_bytes") if xlsx_key else None
+xlsx_name: str | None = st.session_state.get("xlsx_name") if xlsx_key else None
 
 if xlsx_bytes is None or xlsx_name is None:
     st.error(
@@ -287,35 +716,28 @@ with st.expander("🛠️ Debug (ver detalhes)", expanded=False):
         st.write("📍 Arquivo XLSX (upload):", xlsx_name)
 
     try:
-        wb_dbg = openpyxl.load_workbook(io.BytesIO(xlsx_bytes), data_only=False)
-        st.write("📄 Abas encontradas:", wb_dbg.sheetnames)
+        # abas listadas uma vez por arquivo (calamine) e guardadas na sessão;
+        # reruns seguintes não re-parseiam nada
+        if "xlsx_sheetnames" not in st.session_state:
+            st.session_state["xlsx_sheetnames"] = CalamineWorkbook.from_filelike(
+                io.BytesIO(xlsx_bytes)
+            ).sheet_names
+        st.write("📄 Abas encontradas:", st.session_state["xlsx_sheetnames"])
     except Exception:
-        st.error("Falha ao abrir o Excel via openpyxl (apenas leitura).")
+        st.error("Falha ao abrir o Excel (apenas leitura).")
         st.code(traceback.format_exc())
 
 # =========================
-# LOAD ENGINE (xlcalculator) COM TRY/EXCEPT
+# LOAD ENGINE + INPUTS (xlcalculator) COM TRY/EXCEPT
 # =========================
 st.write("Debug: antes de carregar engine do Excel (xlcalculator)")
 
 try:
-    engine = load_engine_from_bytes(xlsx_bytes)
+    engine, inputs = load_engine_from_bytes(xlsx_bytes, xlsx_key)
     st.success("✅ Engine do Excel carregada (xlcalculator).")
-except Exception:
-    st.error("❌ Falha ao carregar engine do Excel (xlcalculator).")
-    st.code(traceback.format_exc())
-    st.stop()
-
-# =========================
-# DISCOVER INPUTS COM TRY/EXCEPT
-# =========================
-st.write("Debug: antes de descobrir inputs na planilha")
-
-try:
-    inputs = cached_inputs(xlsx_bytes, MAIN_SHEET)
     st.success(f"✅ Inputs descobertos: {len(inputs)}")
 except Exception:
-    st.error("❌ Falha ao ler a planilha / aba / inputs.")
+    st.error("❌ Falha ao carregar engine do Excel / ler a planilha / inputs.")
     st.code(traceback.format_exc())
     st.stop()
 
@@ -336,39 +758,78 @@ df["value"] = df["default"]
 st.subheader("✍️ Entradas (editáveis)")
 st.caption("Edite os campos. Clique em **Calcular** para atualizar os KPIs.")
 
+EDITOR_KEY = "inputs_editor"
+
+
+def _reset_inputs():
+    # callback do Resetar: limpa o estado do editor; o rerun que segue o
+    # callback redesenha a tabela com os defaults
+    st.session_state.pop(EDITOR_KEY, None)
+
+
 edited = st.data_editor(
     df[["label", "address", "value"]],
     use_container_width=True,
     num_rows="fixed",
+    key=EDITOR_KEY,
     column_config={
         "label": st.column_config.TextColumn("Campo"),
         "address": st.column_config.TextColumn("Célula (Excel)"),
         "value": st.column_config.TextColumn("Valor"),
     },
 )
+# edições no editor forçam rerun completo, então aqui está sempre fresco;
+# o fragmento abaixo lê daqui nos reruns parciais do Calcular
+st.session_state["edited_inputs"] = edited
 
-col1, col2, col3 = st.columns([1, 1, 3])
-with col1:
-    calc = st.button("🧮 Calcular", type="primary")
-with col2:
-    reset = st.button("↩️ Resetar")
-with col3:
-    st.info("Dica: números podem ser digitados como 1000 ou 1.000,00 (pt-br).")
-
-if reset:
-    st.rerun()
 
 # =========================
-# CALC + OUTPUTS
+# CALC + OUTPUTS (fragmento: o Calcular reroda só este bloco,
+# sem reexecutar upload, descoberta e caches do script inteiro)
 # =========================
-if calc:
-    st.write("Debug: aplicando inputs...")
+@st.fragment
+def kpi_panel():
+    col1, col2, col3 = st.columns([1, 1, 3])
+    with col1:
+        calc = st.button("🧮 Calcular", type="primary")
+    with col2:
+        reset = st.button("↩️ Resetar", on_click=_reset_inputs)
+    with col3:
+        st.info("Dica: números podem ser digitados como 1000 ou 1.000,00 (pt-br).")
+
+    if reset:
+        # o clique num botão do fragmento só reroda o fragmento; o editor
+        # fica fora dele, então força um rerun completo para a tabela ser
+        # redesenhada com os defaults (a chave já foi limpa no callback)
+        st.rerun(scope="app")
+
+    if not calc:
+        return
 
-    edited2 = edited.copy()
-    edited2["value"] = edited2["value"].apply(coerce_value)
+    st.write("Debug: aplicando inputs...")
 
-    for _, row in edited2.iterrows():
-        engine.set_cell_value(row["address"], row["value"])
+    edited2 = st.session_state["edited_inputs"].copy()
+    edited2["value"] = coerce_values(edited2["value"])
+
+    # dict endereço -> valor montado em bloco (iterrows constrói uma Series
+    # por linha; zip sobre os arrays não)
+    new_values = dict(zip(edited2["address"].to_numpy(), edited2["value"].to_numpy()))
+    set_cell_values(engine, new_values)
+
+    # Recomputa em ordem topológica só o que foi afetado. Fórmula já
+    # resolvida fica com evaluate=False e vira leitura do valor armazenado,
+    # então precedentes compartilhados entre KPIs são avaliados uma vez só.
+    dirty = _dirty_descendants(engine._dependents, new_values)
+    formulae = engine.model.formulae
+    for addr in engine._eval_order:
+        f = formulae[addr]
+        if f.evaluate or addr in dirty:
+            f.evaluate = True
+            try:
+                engine.evaluate(addr)
+                f.evaluate = False
+            except Exception:
+                pass  # o KPI correspondente mostra o erro via safe_eval
 
     st.subheader("📌 KPIs")
     cols = st.columns(4)
@@ -383,3 +844,6 @@ if calc:
     st.subheader("🧾 Logs / Erros")
     st.caption("Se algum KPI der erro, normalmente é fórmula não suportada pelo motor.")
     st.write("Se aparecer 'Erro:', me diga o KPI/célula e eu ajusto a estratégia.")
+
+
+kpi_panel()